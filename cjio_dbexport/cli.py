@@ -78,10 +78,6 @@ def export_all_cmd(ctx, filename):
     if not Path(path.parent).exists():
         raise NotADirectoryError(f"Directory {path.parent} not exists")
     conn = db.Db(**ctx.obj['cfg']['database'])
-    if not conn.create_functions():
-        raise click.exceptions.ClickException(
-            "Could not create the required functions in PostgreSQL, "
-            "check the logs for details")
     try:
         click.echo(f"Exporting the whole database")
         dbexport = db3dnl.query(conn_cfg=ctx.obj['cfg']['database'],
@@ -160,8 +156,6 @@ def export_bbox_cmd(ctx, bbox, filename):
     if not Path(path.parent).exists():
         raise NotADirectoryError(f"Directory {path.parent} not exists")
     conn = db.Db(**ctx.obj['cfg']['database'])
-    if not conn.create_functions():
-        raise click.exceptions.ClickException("Could not create the required functions in PostgreSQL, check the logs for details")
     try:
         click.echo(f"Exporting with BBOX={bbox}")
         dbexport = db3dnl.query(conn_cfg=ctx.obj['cfg']['database'],
@@ -197,8 +191,6 @@ def export_extent_cmd(ctx, extent, filename):
 
     polygon = cjio_dbexport.utils.read_geojson_polygon(extent)
     conn = db.Db(**ctx.obj['cfg']['database'])
-    if not conn.create_functions():
-        raise click.exceptions.ClickException("Could not create the required functions in PostgreSQL, check the logs for details")
     try:
         click.echo(f"Exporting with polygonal selection. Polygon={extent.name}")
         dbexport = db3dnl.query(conn_cfg=ctx.obj['cfg']['database'],
@@ -256,11 +248,12 @@ def index_cmd(ctx, extent, tilesize, drop):
     click.echo(f"Tilesize is set to width={tilesize[0]}, height={tilesize[1]}"
                f" in CRS units")
     # Create a rectangular grid of 4**x cells
-    grid = utils.create_rectangle_grid_morton(bbox=bbox, hspacing=tilesize[0],
-                                              vspacing=tilesize[1])
+    codes, grid = utils.create_rectangle_grid_morton(bbox=bbox,
+                                                     hspacing=tilesize[0],
+                                                     vspacing=tilesize[1])
     click.echo(f"Created {len(grid)} tiles")
     # Create the IDs for the tiles
-    quadtree_idx = utils.index_quadtree(grid)
+    quadtree_idx = utils.index_quadtree(codes)
     # Check if schema and table exists
     conn = db.Db(**ctx.obj['cfg']['database'])
     try:
@@ -302,12 +295,11 @@ def index_cmd(ctx, extent, tilesize, drop):
                 f"{tile_index.table.string} in {conn.dbname}. Check the logs for "
                 f"details.")
         # Upload the tile_index to the database
-        values = StringIO()
-        for idx, code in quadtree_idx.items():
-            ewkt = utils.to_ewkt(polygon=grid[code],
-                                 srid=ctx.obj['cfg']['tile_index']['srid'])
-            values.write(f'{idx}\t{ewkt}\n')
-        values.seek(0)
+        # The IDs are in the same (Morton) order as the cells of the grid
+        ewkts = utils.grid_to_ewkt(polygons=grid,
+                                   srid=ctx.obj['cfg']['tile_index']['srid'])
+        values = StringIO("".join([f'{idx}\t{ewkt}\n'
+                                   for idx, ewkt in zip(quadtree_idx, ewkts)]))
         log.debug(f"First <value>={values.readline()}")
         values.seek(0)
         try:
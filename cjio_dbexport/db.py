@@ -23,17 +23,49 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import hashlib
 import logging
+import os
 import re
-from typing import List, Tuple
+import threading
+import weakref
+from typing import List, Tuple, Iterator, Sequence, Mapping
 from collections import abc
 from keyword import iskeyword
 
 import psycopg2
-from psycopg2 import sql, extras, extensions, errors
+from psycopg2 import sql, extras, extensions, errors, pool
+
+from cjio_dbexport import settings
 
 log = logging.getLogger(__name__)
 
+# Field names of the tables, keyed by (DSN, table), see Db.get_fields
+_fields_cache = {}
+# Names of the prepared statements of each connection, see Db.prepare
+_prepared_statements = weakref.WeakKeyDictionary()
+# Runs of newlines and spaces in a query, see Db.print_query
+_whitespace = re.compile(r'[\n ]+')
+# Connection pools of the process, keyed by (PID, connection parameters), see
+# get_pool
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(conn_cfg: Mapping) -> pool.ThreadedConnectionPool:
+    """Get the connection pool of the current process, created on the first
+    call."""
+    key = (os.getpid(), tuple(sorted(conn_cfg.items())))
+    with _pools_lock:
+        conn_pool = _pools.get(key)
+        if conn_pool is None:
+            conn_pool = pool.ThreadedConnectionPool(
+                minconn=1, maxconn=(os.cpu_count() or 1) * 2, **conn_cfg
+            )
+            _pools[key] = conn_pool
+            log.debug(f"Created a connection pool for process {key[0]}")
+    return conn_pool
+
 
 class Db(object):
     """A database connection class.
@@ -68,33 +100,88 @@ class Db(object):
             with self.conn.cursor() as cur:
                 cur.execute(query)
 
-    def get_query(self, query: psycopg2.sql.Composable) -> List[Tuple]:
+    def get_query(self, query: psycopg2.sql.Composable,
+                  params: Sequence = None) -> List[Tuple]:
         """DB query where the results need to return (e.g. SELECT)."""
         with self.conn:
             with self.conn.cursor() as cur:
-                cur.execute(query)
+                cur.execute(query, params)
                 return cur.fetchall()
 
-    def get_dict(self, query: psycopg2.sql.Composable) -> dict:
-        """DB query where the results need to return as a dictionary."""
+    def get_dict(self, query: psycopg2.sql.Composable,
+                 params: Sequence = None,
+                 local_settings: Mapping[str, str] = None) -> dict:
+        """DB query where the results need to return as a dictionary.
+
+        :param query: The query
+        :param params: Parameters of the query
+        :param local_settings: Run-time parameters of PostgreSQL that are SET
+            LOCAL for the transaction of the query only. They are sent together
+            with the query, in the same round-trip.
+        """
+        if local_settings:
+            if isinstance(query, str):
+                query = sql.SQL(query)
+            set_configs = ", ".join(
+                ["set_config(%s, %s, true)"] * len(local_settings))
+            query = sql.Composed([sql.SQL(f"SELECT {set_configs}; "), query])
+            params = [v for item in local_settings.items() for v in item] + \
+                     list(params or ())
         with self.conn:
             with self.conn.cursor(
                 cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(query)
+                cur.execute(query, params)
                 return cur.fetchall()
 
+    def iter_dict(self, query: psycopg2.sql.Composable, name: str,
+                  itersize: int = settings.itersize) -> Iterator[dict]:
+        """DB query where the results are streamed as dictionaries.
+
+        Uses a server-side (named) cursor, so only ``itersize`` records are
+        held in memory at a time. The query is executed when this method is
+        called, the records are fetched while iterating the returned generator.
+
+        :param name: Name of the server-side cursor
+        :param itersize: Number of records to fetch in one network round-trip
+        """
+        cur = self.conn.cursor(name=name,
+                               cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.itersize = itersize
+        try:
+            cur.execute(query)
+        except psycopg2.Error:
+            cur.close()
+            self.conn.rollback()
+            raise
+        return self._iter_cursor(cur)
+
+    def _iter_cursor(self, cur) -> Iterator[dict]:
+        """Iterate a named cursor and end its transaction when exhausted."""
+        with self.conn:
+            with cur:
+                yield from cur
+
+    def prepare(self, query: psycopg2.sql.Composable,
+                nr_params: int = 1) -> sql.Composed:
+        """PREPARE a query once per connection and return its EXECUTE
+        statement."""
+        query_str = query.as_string(self.conn)
+        name = f"cjdb_{hashlib.md5(query_str.encode('utf-8')).hexdigest()}"
+        prepared = _prepared_statements.setdefault(self.conn, set())
+        if name not in prepared:
+            self.send_query(sql.SQL("PREPARE {name} AS {query}").format(
+                name=sql.Identifier(name), query=query))
+            prepared.add(name)
+        return sql.SQL("EXECUTE {name}({params})").format(
+            name=sql.Identifier(name),
+            params=sql.SQL(", ").join(sql.Placeholder() * nr_params)
+        )
+
     def print_query(self, query: psycopg2.sql.Composable) -> str:
         """Format a SQL query for printing by replacing newlines and tab-spaces.
         """
-
-        def repl(matchobj):
-            if matchobj.group(0) == '    ':
-                return ' '
-            else:
-                return ' '
-
         s = query.as_string(self.conn).strip()
-        return re.sub(r'[\n    ]{1,}', repl, s)
+        return _whitespace.sub(' ', s)
 
     def vacuum(self, schema: str, table: str):
         """Vacuum analyze a table."""
@@ -123,106 +210,26 @@ class Db(object):
         return version
 
     def get_fields(self, table):
-        """List the fields in a table."""
-        query = sql.SQL("SELECT * FROM {table} LIMIT 0;").format(table=table)
-        with self.conn:
-            with self.conn.cursor() as cur:
-                cur.execute(query)
-                return [desc[0] for desc in cur.description]
+        """List the fields in a table.
+
+        The fields are cached per database and table for the lifetime of the
+        process, because they are requested for each table of each exported
+        tile.
+        """
+        key = (self.conn.dsn, table.as_string(self.conn))
+        if key not in _fields_cache:
+            query = sql.SQL("SELECT * FROM {table} LIMIT 0;").format(table=table)
+            with self.conn:
+                with self.conn.cursor() as cur:
+                    cur.execute(query)
+                    _fields_cache[key] = tuple(desc[0] for desc in cur.description)
+        return list(_fields_cache[key])
 
     def close(self):
         """Close connection."""
         self.conn.close()
         log.debug("Closed database successfully")
 
-    def create_functions(self) -> bool:
-        """Create the required functions in PostgreSQL.
-
-        ``cjdb_multipolygon_to_multisurface()``
-
-            Parse the PostGIS geometry representation into
-            a CityJSON-like geometry array representation. Here I use
-            several subqueries for sequentially aggregating the vertices,
-            rings and surfaces. I also tested the aggregation with window
-            function calls, but this approach tends to be at least twice
-            as expensive then the subquery-aggregation.
-            In the expand_point subquery, the first vertex is skipped,
-            because PostGIS uses Simple Features so the first vertex is
-            duplicated at the end.
-        """
-        mpoly_to_msrf = sql.SQL("""
-        CREATE OR REPLACE
-        FUNCTION cjdb_multipolygon_to_multisurface(
-            multipolygon geometry
-        ) RETURNS FLOAT8[] AS $$ 
-        WITH polygons AS (
-            SELECT
-                ST_DumpPoints(multipolygon) geom
-        )
-        , expand_points AS (
-            SELECT
-                (geom).PATH[1] exterior
-                , (geom).PATH[2] interior
-                , (geom).PATH[3] vertex
-                , ARRAY[ST_X((geom).geom)
-                , ST_Y((geom).geom)
-                , ST_Z((geom).geom)] point
-            FROM
-                polygons
-            WHERE
-                (geom).PATH[3] > 1
-                ORDER BY exterior
-                , interior
-                , vertex
-        )
-        , rings AS (
-            SELECT
-                exterior
-                , interior
-                , ARRAY_AGG(point) geom
-            FROM
-                expand_points
-            GROUP BY
-                interior
-                , exterior
-            ORDER BY
-                exterior
-                , interior
-        )
-        , surfaces AS (
-            SELECT
-                ARRAY_AGG(geom) geom
-            FROM
-                rings
-            GROUP BY
-                exterior
-            ORDER BY
-                exterior
-        )
-        SELECT
-            ARRAY_AGG(geom) geom
-        FROM
-            surfaces;
-        $$ LANGUAGE SQL;
-        
-        COMMENT ON 
-        FUNCTION cjdb_multipolygon_to_multisurface(
-            IN multipolygon geometry
-        ) IS 'Cast a PostGIS MultiPolygon geometry into a CityJSON MultiSurface 
-        geometry array representation.';
-        """)
-        success = []
-        try:
-            self.send_query(mpoly_to_msrf)
-            log.info("Created PostgreSQL FUNCTION "
-                     "cjdb_multipolygon_to_multisurface()")
-            success.append(True)
-        except psycopg2.Error as e:
-            log.exception(f"Error creating PostgreSQL FUNCTION "
-                          f"cjdb_multipolygon_to_multisurface()\n{e.pgerror}")
-            success.append(False)
-        return all(success)
-
 
 def identifier(relation_name):
     """Property factory for returning a :class:`psycopg2.sql.Identifier`."""
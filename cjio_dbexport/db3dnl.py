@@ -24,13 +24,13 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import logging
-import re
+import os
+import struct
 from concurrent.futures._base import as_completed
 from concurrent.futures.process import ProcessPoolExecutor
 from datetime import date, time, datetime, timedelta
-from typing import Mapping, Sequence, Tuple, List
+from typing import Mapping, Sequence, Tuple, List, Optional, Iterator
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import json
 from pathlib import Path
 
 import click
@@ -46,9 +46,6 @@ log = logging.getLogger(__name__)
 
 def get_tile_list(cfg: Mapping, tiles: List) -> List:
     conn = db.Db(**cfg['database'])
-    if not conn.create_functions():
-        raise BaseException(
-            "Could not create the required functions in PostgreSQL, check the logs for details")
     tile_index = db.Schema(cfg['tile_index'])
     try:
         tile_list = with_list(conn=conn, tile_index=tile_index,
@@ -70,11 +67,19 @@ def export_tiles_multiprocess(cfg: Mapping, jobs: int, path: Path, tile_list: Li
         prefix_file = ""
     if not path.exists():
         raise NotADirectoryError(str(path))
-    with ProcessPoolExecutor(max_workers=jobs) as executor:
+    # More processes than cores (or tiles) only adds overhead, because the
+    # conversion to CityJSON is CPU-bound
+    max_workers = max(1, min(jobs, os.cpu_count() or 1, len(tile_list)))
+    if max_workers < jobs:
+        log.info(f"Reduced the number of parallel jobs to {max_workers}")
+    # The configuration is passed once to each worker, not with each tile
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=_init_worker,
+                             initargs=(cfg,)) as executor:
         for tile in tile_list:
             filepath = (path / f"{prefix_file}{tile}").with_suffix('.json')
-            futures.append(executor.submit(export, tile, filepath,
-                                           cfg, zip))
+            futures.append(executor.submit(_export_worker, tile, filepath,
+                                           zip))
 
         for i, future in enumerate(as_completed(futures)):
             success, filepath = future.result()
@@ -91,6 +96,22 @@ def export_tiles_multiprocess(cfg: Mapping, jobs: int, path: Path, tile_list: Li
                 "failed": failed}
 
 
+# The configuration of the export in a worker process of
+# export_tiles_multiprocess, set by _init_worker
+_worker_cfg = None
+
+
+def _init_worker(cfg: Mapping):
+    """Store the configuration in the worker process."""
+    global _worker_cfg
+    _worker_cfg = cfg
+
+
+def _export_worker(tile, filepath, zip: bool = False):
+    """Export a tile with the configuration of the worker process."""
+    return export(tile, filepath, _worker_cfg, zip)
+
+
 def export(tile, filepath, cfg, zip: bool = False):
     """Export a tile from PostgreSQL, convert to CityJSON and write to file."""
     try:
@@ -111,14 +132,14 @@ def export(tile, filepath, cfg, zip: bool = False):
     if cm is not None:
         cm.j["metadata"]["fileIdentifier"] = filepath.name
         try:
-            json_str = json.dumps(cm.j, separators=(',', ':'))
+            json_bytes = utils.dumps_json(cm.j)
             if zip:
-                filepath = utils.write_zip(data=json_str.encode("utf-8"),
+                filepath = utils.write_zip(data=json_bytes,
                                            filename=filepath.name,
                                            outdir=filepath.parent)
             else:
-                with open(filepath, "w") as fout:
-                    fout.write(json_str)
+                with open(filepath, "wb") as fout:
+                    fout.write(json_bytes)
             return True, filepath
         except IOError as e:
             log.error(f"Invalid output file: {filepath}\n{e}")
@@ -129,7 +150,7 @@ def export(tile, filepath, cfg, zip: bool = False):
         finally:
             del cm
             try:
-                del json_str
+                del json_bytes
             except NameError:
                 pass
     else:
@@ -142,33 +163,32 @@ def export(tile, filepath, cfg, zip: bool = False):
 
 def to_citymodel(dbexport, cfg, compress: bool = True, important_digits: int = 3):
     try:
-        cm = convert(dbexport, cfg=cfg)
+        # The extent is computed when the vertices are cleaned
+        cm = convert(dbexport, cfg=cfg, update_bbox=False)
     except BaseException as e:
         log.error(f"Failed to convert database export to CityJSON\n{e}")
         return None
     if cm and compress:
         try:
-            cm.compress(important_digits=important_digits)
+            utils.compress(cm.j, important_digits=important_digits)
         except BaseException as e:
             log.error(f"Failed to compress cityjson\n{e}")
             return None
         return cm
     elif cm and not compress:
         try:
-            cm.remove_duplicate_vertices()
+            utils.clean_vertices(cm.j)
         except BaseException as e:
-            log.error(f"Failed to remove duplicate vertices\n{e}")
-            return None
-        try:
-            cm.remove_orphan_vertices()
-        except BaseException as e:
-            log.error(f"Failed to remove orphan vertices\n{e}")
+            log.error(f"Failed to remove duplicate and orphan vertices\n{e}")
             return None
         return cm
 
 
-def convert(dbexport, cfg):
-    """Convert the exported citymodel to CityJSON. """
+def convert(dbexport, cfg, update_bbox: bool = True):
+    """Convert the exported citymodel to CityJSON.
+
+    :param update_bbox: Compute the geographicalExtent of the citymodel
+    """
     # Set EPSG
     epsg = 7415
     # Set rounding for floating point attributes
@@ -182,7 +202,12 @@ def convert(dbexport, cfg):
     log.debug("Adding to json")
     cm.add_to_j(cityobjects, vertex_lookup)
     log.debug("Updating metadata")
-    cm.update_metadata(overwrite=True, new_uuid=True)
+    if update_bbox:
+        cm.update_metadata(overwrite=True, new_uuid=True)
+    else:
+        cm.j.setdefault("metadata", {})
+        cm.j["metadata"], _ = cm.compute_metadata(overwrite=True,
+                                                  new_uuid=True)
     log.debug("Setting EPSG")
     cm.set_epsg(epsg)
     log.info(f"Exported CityModel:\n{cm}")
@@ -195,7 +220,8 @@ def dbexport_to_cityobjects(dbexport, cfg, rounding=4):
         cfg_geom = None
         for _c in cfg["cityobject_type"][cotype]:
             if _c["table"] == cotable:
-                cfg_geom = _c["field"]["geometry"]
+                # Copy, because the configuration is reused for the next tiles
+                cfg_geom = dict(_c["field"]["geometry"])
                 cfg_geom['lod'] = _c["field"].get('lod')
                 cfg_geom['semantics'] = _c["field"].get('semantics')
                 cfg_geom['tile_id'] = _c["field"].get('tile')
@@ -211,53 +237,93 @@ def dbexport_to_cityobjects(dbexport, cfg, rounding=4):
 
 def table_to_cityobjects(tabledata, cotype: str, cfg_geom: dict, rounding: int):
     """Converts a database record to a CityObject."""
+    # Special fields that serve some purpose are not attributes, eg. primary
+    # key (pk) or cityobject ID (coid)
+    special_fields = {'pk', 'coid', cfg_geom['lod'], cfg_geom['semantics'],
+                      cfg_geom['tile_id']}
+    attribute_keys = None
+    lods = lod_columns(cfg_geom)
     for record in tabledata:
+        if attribute_keys is None:
+            # All records of the table have the same fields
+            attribute_keys = [key for key in record
+                              if key not in special_fields and "geom_" not in key]
         coid = str(record["coid"])
         co = CityObject(id=coid)
         # Parse the geometry
-        co.geometry = record_to_geometry(record, cfg_geom)
-        # Parse attributes, except special fields that serve some purpose,
-        # eg. primary key (pk) or cityobject ID (coid)
-        special_fields = ('pk', 'coid', cfg_geom['lod'], cfg_geom['semantics'],
-                          cfg_geom['tile_id'])
-        for key, attr in record.items():
-            if key not in special_fields and "geom_" not in key:
-                if isinstance(attr, float):
-                    co.attributes[key] = round(attr, rounding)
-                elif isinstance(attr, date) or isinstance(attr, time) or isinstance(attr, datetime):
-                    co.attributes[key] = attr.isoformat()
-                elif isinstance(attr, timedelta):
-                    co.attributes[key] = str(attr)
-                else:
-                    co.attributes[key] = attr
+        co.geometry = record_to_geometry(record, cfg_geom, lods=lods)
+        # Parse attributes
+        co.attributes = {key: parse_attribute(record[key], rounding)
+                         for key in attribute_keys}
         # Set the CityObject type
         co.type = cotype
         yield coid, co
 
 
-def record_to_geometry(record: Mapping, cfg_geom: dict) -> Sequence[Geometry]:
-    """Create a CityJSON Geometry from a boundary array that was retrieved from
+def parse_attribute(attr, rounding: int):
+    """Convert an attribute value to a type that can be serialized to JSON.
+
+    Floats are rounded to ``rounding`` decimal digits, dates and times are
+    formatted as ISO 8601 strings.
+    """
+    attr_type = type(attr)
+    if attr_type is float:
+        return round(attr, rounding)
+    elif attr_type in (date, time, datetime):
+        return attr.isoformat()
+    elif attr_type is timedelta:
+        return str(attr)
+    else:
+        return attr
+
+
+def lod_columns(cfg_geom: dict) -> List[Tuple[str, str, Optional[float]]]:
+    """Get the geometry columns of a table, one for each LoD.
+
+    All the LoD-s are selected in the same query, see :func:`sql_cast_geometry`,
+    so this is computed once for the table instead of for each record.
+
+    :return: A list of (column alias, geometry type, LoD) for each LoD. The LoD
+        is None if it is read from the 'lod' column of each record.
+    """
+    skip_keys = ('lod', 'semantics', 'semantics_mapping', 'tile_id')
+    lods = []
+    for lod_key in [k for k in cfg_geom if k not in skip_keys]:
+        if cfg_geom.get('lod'):
+            lod_float = None
+        else:
+            lod_float = round(float(utils.parse_lod_value(lod_key)), 1)
+        lods.append((settings.geom_prefix + lod_key, cfg_geom[lod_key]["type"],
+                     lod_float))
+    return lods
+
+
+def record_to_geometry(record: Mapping, cfg_geom: dict,
+                       lods: List[Tuple[str, str, Optional[float]]] = None
+                       ) -> Sequence[Geometry]:
+    """Create a CityJSON Geometry from the WKB geometry that was retrieved from
     Postgres.
+
+    :param lods: The geometry columns of the table, see :func:`lod_columns`
     """
+    if lods is None:
+        lods = lod_columns(cfg_geom)
     geometries = []
     lod_column = cfg_geom.get('lod')
     semantics_column = cfg_geom.get('semantics')
-    skip_keys = ('lod', 'semantics', 'semantics_mapping', 'tile_id')
-    for lod_key in [k for k in cfg_geom if k not in skip_keys]:
-        if lod_column:
-            lod = record[lod_column]
-        else:
-            lod = utils.parse_lod_value(lod_key)
-        lod_float = round(float(lod), 1)
-        geomtype = cfg_geom[lod_key]["type"]
+    for geom_alias, geomtype, lod_float in lods:
+        if lod_float is None:
+            lod_float = round(float(record[lod_column]), 1)
         geom = Geometry(type=geomtype, lod=lod_float)
+        wkb = record.get(geom_alias)
+        msurface = parse_wkb_multipolygonz(wkb) if wkb is not None else None
         if geomtype == "Solid":
             solid = [
-                record.get(settings.geom_prefix + lod_key),
+                msurface,
             ]
             geom.boundaries = solid
         elif geomtype == "MultiSurface":
-            geom.boundaries = record.get(settings.geom_prefix + lod_key)
+            geom.boundaries = msurface
         if semantics_column and lod_float >= 2.0:
             geom.surfaces = record_to_surfaces(
                 geomtype=geomtype,
@@ -300,8 +366,17 @@ def query(
     tile_list=None,
     bbox=None,
     extent=None,
+    tile_batch_size: int = 32,
 ):
-    """Export a table from PostgreSQL. Multithreading, with connection pooling."""
+    """Export a table from PostgreSQL. Multithreading, with connection pooling.
+
+    On a single thread the records of each table are streamed from a
+    server-side cursor, thus they must be consumed before advancing to the
+    next table.
+
+    :param tile_batch_size: The tiles of the ``tile_list`` are queried in
+        batches of this size, see :func:`query_tile_batches`
+    """
     # see: https://realpython.com/intro-to-python-threading/
     # see: https://stackoverflow.com/a/39310039
     # Need one thread per table
@@ -309,7 +384,8 @@ def query(
         threads = sum(len(cotables) for cotables in cityobject_type.values())
     if threads == 1:
         log.debug(f"Running on a single thread.")
-        conn = db.Db(**conn_cfg)
+        conn_pool = db.get_pool(conn_cfg)
+        conn = db.Db(conn=conn_pool.getconn())
         try:
             for cotype, cotables in cityobject_type.items():
                 for cotable in cotables:
@@ -326,16 +402,31 @@ def query(
                         extent=extent,
                     )
                     try:
-                        # Note that resultset can be []
-                        yield (cotype, tablename), conn.get_dict(sql_query)
+                        sql_query, prepared = prepare_query(
+                            conn=conn, query=sql_query, tile_list=tile_list,
+                            bbox=bbox
+                        )
+                        # Note that resultset can be empty.
+                        if not prepared:
+                            # The records are streamed, thus they need to be
+                            # consumed before advancing to the next table.
+                            records = conn.iter_dict(sql_query,
+                                                     name=f"export_{tablename}")
+                        else:
+                            # A prepared statement cannot be executed in a
+                            # server-side cursor, thus the records are
+                            # streamed per batch of tiles.
+                            records = query_tile_batches(
+                                conn, sql_query, tile_list, tile_batch_size)
                     except pgError as e:
                         log.error(f"{e.pgcode}\t{e.pgerror}")
                         raise ClickException(
                             f"Could not query {cotable}. Check the "
                             f"logs for details."
                         )
+                    yield (cotype, tablename), records
         finally:
-            conn.close()
+            conn_pool.putconn(conn.conn)
     elif threads > 1:
         log.debug(f"Running with ThreadPoolExecutor, nr. of threads={threads}")
         pool_size = sum(len(cotables) for cotables in cityobject_type.values())
@@ -363,25 +454,47 @@ def query(
                             bbox=bbox,
                             extent=extent,
                         )
+                        sql_query, prepared = prepare_query(
+                            conn=conn, query=sql_query, tile_list=tile_list,
+                            bbox=bbox
+                        )
                         # Schedule the DB query for execution and store the returned
                         # Future together with the cotype and table name
-                        future = executor.submit(conn.get_dict, sql_query)
+                        if prepared:
+                            future = executor.submit(
+                                _fetch_tile_batches, conn, sql_query,
+                                tile_list, tile_batch_size)
+                        else:
+                            future = executor.submit(conn.get_dict, sql_query)
                         future_to_table[future] = (cotype, tablename)
                         # If I put away the connection here, then it locks the main
                         # thread and it becomes like using a single connection.
                         # conn_pool.putconn(conn=conn.conn, key=(cotype, tablename),
                         #                   close=True)
+                failed = []
                 for future in as_completed(future_to_table):
                     cotype, tablename = future_to_table[future]
+                    if future.cancelled():
+                        continue
                     try:
                         # Note that resultset can be []
-                        yield (cotype, tablename), future.result()
+                        records = future.result()
                     except pgError as e:
-                        log.error(f"{e.pgcode}\t{e.pgerror}")
-                        raise ClickException(
-                            f"Could not query {tablename}. Check the "
-                            f"logs for details."
-                        )
+                        log.error(f"{tablename}\t{e.pgcode}\t{e.pgerror}")
+                        if not failed:
+                            # The export fails anyway, do not start the
+                            # queries that are still waiting
+                            for pending in future_to_table:
+                                pending.cancel()
+                        failed.append(tablename)
+                        continue
+                    if not failed:
+                        yield (cotype, tablename), records
+                if failed:
+                    raise ClickException(
+                        f"Could not query {', '.join(failed)}. Check the "
+                        f"logs for details."
+                    )
         finally:
             conn_pool.closeall()
     else:
@@ -398,6 +511,9 @@ def build_query(
 ):
     """Build an SQL query for extracting CityObjects from a single table.
 
+    If the selection is done with the ``tile_list``, then the tile IDs are
+    the parameter ``$1`` of the query, see :func:`prepare_query`.
+
     ..todo: make EPSG a parameter
     """
     # Set EPSG
@@ -420,171 +536,153 @@ def build_query(
         and col != features.field.cityobject_id.string
         and col not in exclude
     )
-    # polygons subquery
+    # Selection of the objects
     if bbox:
         log.info(f"Exporting with BBOX {bbox}")
-        polygons_sub, attr_where, extent_sub = query_bbox(features, bbox, epsg)
+        sql_where = query_bbox(features, bbox, epsg)
     elif tile_list:
         log.info(f"Exporting with a list of tiles {tile_list}")
         if features.field.get("tile"):
             log.debug(f"Found 'tile' tag in the cityobject table, matching objects on tile ID")
-            polygons_sub, attr_where, extent_sub = query_tiles_in_list(
-                features=features, tile_index=tile_index, tile_list=tile_list,
+            sql_where = query_tiles_in_list(
+                features=features, tile_index=tile_index,
                 with_intersection=False
             )
         else:
-            polygons_sub, attr_where, extent_sub = query_tiles_in_list(
-                features=features, tile_index=tile_index, tile_list=tile_list
+            sql_where = query_tiles_in_list(
+                features=features, tile_index=tile_index
             )
     elif extent:
         log.info(f"Exporting with polygon extent")
         ewkt = utils.to_ewkt(polygon=extent, srid=epsg)
-        polygons_sub, attr_where, extent_sub = query_extent(
-            features=features, ewkt=ewkt
-        )
+        sql_where = query_extent(features=features, ewkt=ewkt)
     else:
         log.info(f"Exporting the whole database")
-        polygons_sub, attr_where, extent_sub = query_all(features=features)
+        sql_where = query_all(features=features)
 
-    # Main query
+    # Main query. The attributes and the geometry are selected in a single scan
+    # of the table, without CTEs that would be an optimization fence for the
+    # planner.
     query_params = {
         "pk": features.field.pk.sqlid,
         "coid": features.field.cityobject_id.sqlid,
         "tbl": features.schema + features.table,
         "attr": attr_select,
-        "where_instersects": attr_where,
-        "extent": extent_sub,
-        "polygons": polygons_sub,
+        "geometries": sql_cast_geometry(features),
+        "where": sql_where,
     }
 
     query = sql.SQL(
         """
-    WITH
-         {extent}
-         attr_in_extent AS (
-             SELECT {pk} pk,
-                    {coid} coid,
-                    {attr}
-             FROM {tbl} a
-             {where_instersects}
-         ),
-         {polygons}
-    SELECT *
-    FROM polygons b
-             INNER JOIN attr_in_extent a ON
-        b.pk = a.pk;
+    SELECT {pk} pk,
+           {coid} coid,
+           {attr},
+           {geometries}
+    FROM {tbl} a
+    {where};
     """
     ).format(**query_params)
-    log.debug(conn.print_query(query))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(conn.print_query(query))
     return query
 
 
-def query_all(features) -> Tuple[sql.Composed, ...]:
-    """Build a subquery of all the geometry in the table."""
-    query_params = {
-        "pk": features.field.pk.sqlid,
-        "coid": features.field.cityobject_id.sqlid,
-        "tbl": features.schema + features.table,
-        "geometries": sql_cast_geometry(features),
-    }
+def prepare_query(conn: db.Db, query: sql.Composed, tile_list=None,
+                  bbox=None) -> Tuple[sql.Composed, bool]:
+    """Prepare the query of a tile list selection.
 
-    sql_polygons = sql.SQL(
-        """
-    polygons AS (
-        SELECT
-            {pk}    pk,
-            {geometries}
-        FROM 
-            {tbl}
-    )
+    The query is PREPAREd once per connection and the tile IDs are bound as its
+    parameter, thus the query is planned only once for all the tiles that are
+    exported through the same connection. The other selections are returned
+    as they are.
+
+    :return: The query to execute and whether it was prepared
     """
-    ).format(**query_params)
+    if tile_list and not bbox:
+        return conn.prepare(query), True
+    else:
+        return query, False
+
+
+def query_tile_batches(conn: db.Db, query: sql.Composed, tile_list: Sequence[str],
+                       tile_batch_size: int = 32) -> Iterator[dict]:
+    """Execute a prepared tile list query per batch of tiles, yield each object
+    once. The first batch is queried immediately."""
+    batches = utils.batched(tile_list, tile_batch_size)
+    first = next(batches, None)
+    if first is None:
+        return iter(())
+    records = conn.get_dict(query, (first,),
+                            local_settings=settings.tile_query_settings)
+    return _iter_tile_batches(conn, query, records, batches)
+
 
-    sql_where_attr_intersects = sql.Composed("")
+def _fetch_tile_batches(conn: db.Db, query: sql.Composed,
+                        tile_list: Sequence[str],
+                        tile_batch_size: int = 32) -> List[dict]:
+    """Get the records of all the batches of :func:`query_tile_batches`."""
+    return list(query_tile_batches(conn, query, tile_list, tile_batch_size))
 
-    sql_extent = sql.Composed("")
 
-    return sql_polygons, sql_where_attr_intersects, sql_extent
+def _iter_tile_batches(conn: db.Db, query: sql.Composed, records: List[dict],
+                       batches: Iterator[List[str]]) -> Iterator[dict]:
+    seen = set()
+    while True:
+        for record in records:
+            if record["pk"] not in seen:
+                seen.add(record["pk"])
+                yield record
+        batch = next(batches, None)
+        if batch is None:
+            return
+        records = conn.get_dict(query, (batch,),
+                                local_settings=settings.tile_query_settings)
+
+
+def query_all(features) -> sql.Composed:
+    """Build the WHERE clause for selecting all the objects in the table."""
+    return sql.Composed("")
 
 
 def query_bbox(
     features: db.Schema, bbox: Sequence[float], epsg: int
-) -> Tuple[sql.Composed, ...]:
-    """Build a subquery of the geometry in a BBOX."""
+) -> sql.Composed:
+    """Build the WHERE clause for selecting the objects in a BBOX.
+
+    The objects are selected with the bounding box operator ``&&``, which is
+    answered by the spatial index alone, without an exact intersection test.
+    """
     # One geometry column is enough to restrict the selection to the BBOX
     lod = list(features.field.geometry.keys())[0]
     query_params = {
-        "pk": features.field.pk.sqlid,
-        "coid": features.field.cityobject_id.sqlid,
-        "geometries": sql_cast_geometry(features),
         "geometry_0": getattr(features.field.geometry, lod).name.sqlid,
         "epsg": sql.Literal(epsg),
         "xmin": sql.Literal(bbox[0]),
         "ymin": sql.Literal(bbox[1]),
         "xmax": sql.Literal(bbox[2]),
         "ymax": sql.Literal(bbox[3]),
-        "tbl": features.schema + features.table,
     }
 
-    sql_polygons = sql.SQL(
+    sql_where = sql.SQL(
         """
-    polygons AS (
-        SELECT {pk}     pk,
-               {geometries}
-        FROM
-            {tbl}
-        WHERE ST_3DIntersects(
-            {geometry_0},
-            ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {epsg})
-            )
-    )
-    """
-    ).format(**query_params)
-
-    sql_where_attr_intersects = sql.SQL(
-        """
-    WHERE ST_3DIntersects(
-        a.{geometry_0},
+    WHERE a.{geometry_0} &&
         ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {epsg})
-        )
     """
     ).format(**query_params)
 
-    sql_extent = sql.Composed("")
+    return sql_where
 
-    return sql_polygons, sql_where_attr_intersects, sql_extent
 
-
-def query_extent(features: db.Schema, ewkt: str) -> Tuple[sql.Composed, ...]:
-    """Build a subquery of the geometry in a polygon."""
+def query_extent(features: db.Schema, ewkt: str) -> sql.Composed:
+    """Build the WHERE clause for selecting the objects in a polygon."""
     # One geometry column is enough to restrict the selection to the BBOX
     lod = list(features.field.geometry.keys())[0]
     query_params = {
-        "pk": features.field.pk.sqlid,
-        "coid": features.field.cityobject_id.sqlid,
-        "geometries": sql_cast_geometry(features),
         "geometry_0": getattr(features.field.geometry, lod).name.sqlid,
-        "tbl": features.schema + features.table,
         "poly": sql.Literal(ewkt),
     }
 
-    sql_polygons = sql.SQL(
-        """
-    polygons AS (
-        SELECT
-            {pk}    pk,
-            {geometries}
-        FROM
-            {tbl}
-        WHERE ST_3DIntersects(
-            {geometry_0},
-            {poly}
-            )
-    )
-    """
-    ).format(**query_params)
-
-    sql_where_attr_intersects = sql.SQL(
+    sql_where = sql.SQL(
     """
     WHERE ST_3DIntersects(
         a.{geometry_0},
@@ -593,93 +691,57 @@ def query_extent(features: db.Schema, ewkt: str) -> Tuple[sql.Composed, ...]:
     """
     ).format(**query_params)
 
-    sql_extent = sql.Composed("")
-
-    return sql_polygons, sql_where_attr_intersects, sql_extent
+    return sql_where
 
 
 def query_tiles_in_list(
-    features: db.Schema, tile_index: db.Schema, tile_list: Sequence[str],
-        with_intersection: bool = True
-) -> Tuple[sql.Composed, ...]:
-    """Build a subquery of the geometry in the tile list.
+    features: db.Schema, tile_index: db.Schema, with_intersection: bool = True
+) -> sql.Composed:
+    """Build the WHERE clause for selecting the objects in the tile list.
+
+    The list of tile IDs is not part of the query, it is the parameter ``$1``
+    of the query, so that the query can be prepared once and executed for
+    each tile.
+
     :param features:
     :param tile_index:
-    :param tile_list:
-    :param with_intersection: If True, use an intersection query (3DIntersects) for
+    :param with_intersection: If True, use the bounding box operator (&&) for
         finding the objects that intersect with the tile boundaries. If False, filter
         the objects whose tile ID is in the `tile_list`. If False, it expects that the
         table contains a column with a one-to-one mapping of objects and tile IDs. This
         column is declared in the cityobject_types.<CO>.field.tile tag.
     :return:
     """
-    tl_tup = tuple(tile_list)
     # One geometry column is enough to restrict the selection to the BBOX
     lod = list(features.field.geometry.keys())[0]
     query_params = {
-        "tbl": features.schema + features.table,
-        "tbl_pk": features.field.pk.sqlid,
-        "tbl_coid": features.field.cityobject_id.sqlid,
         "tbl_geom": getattr(features.field.geometry, lod).name.sqlid,
         "tbl_tile": sql.Identifier(features.field.get("tile", "")),
-        "geometries": sql_cast_geometry(features),
         "tile_index": tile_index.schema + tile_index.table,
         "tx_geom": tile_index.field.geometry.sqlid,
         "tx_pk": tile_index.field.pk.sqlid,
-        "tile_list": sql.Literal(tl_tup),
+        "tile_list": sql.SQL("$1"),
     }
 
     if with_intersection:
-        sql_extent = sql.SQL(
-            """
-        extent AS (
-            SELECT ST_Union({tx_geom}) geom
-            FROM {tile_index}
-            WHERE {tx_pk} IN {tile_list}),
-        """
-        ).format(**query_params)
-
-        sql_polygon = sql.SQL(
+        # A semi-join on the tile index, so that the planner can look up the
+        # objects tile-by-tile in the spatial index and an object that
+        # intersects several tiles is selected only once
+        sql_where = sql.SQL(
             """
-        geom_in_extent AS (
-            SELECT a.*
-            FROM {tbl} a,
-                extent t
-            WHERE ST_3DIntersects(t.geom,
-                                a.{tbl_geom})),
-        polygons AS (
-            SELECT 
-                {tbl_pk} pk,
-                {geometries}
-            FROM geom_in_extent b)
-        """
-        ).format(**query_params)
-
-        sql_where_attr_intersects = sql.SQL(
-            """
-        ,extent t WHERE ST_3DIntersects(t.geom, a.{tbl_geom})
+        WHERE EXISTS (
+            SELECT 1
+            FROM {tile_index} t
+            WHERE t.{tx_pk} = ANY({tile_list})
+              AND t.{tx_geom} && a.{tbl_geom})
         """
         ).format(**query_params)
     else:
-        sql_polygon = sql.SQL(
-        """
-        polygons AS (
-            SELECT 
-                {tbl_pk} pk,
-                {geometries}
-            FROM {tbl} b
-            WHERE b.{tbl_tile} IN {tile_list}
-            )
-        """
-        ).format(**query_params)
-
-        sql_where_attr_intersects = sql.SQL("""
-        WHERE {tbl_tile} IN {tile_list}
+        sql_where = sql.SQL("""
+        WHERE a.{tbl_tile} = ANY({tile_list})
         """).format(**query_params)
 
-        sql_extent = sql.Composed("")
-
-    return sql_polygon, sql_where_attr_intersects, sql_extent
+    return sql_where
 
 
 def with_list(conn: db.Db, tile_index: db.Schema, tile_list: Tuple[str]) -> List[str]:
@@ -699,13 +761,13 @@ def with_list(conn: db.Db, tile_index: db.Schema, tile_list: Tuple[str]) -> List
 def tiles_in_index(
     conn: db.Db, tile_index: db.Schema, tile_list: Tuple[str]
 ) -> Tuple[List[str], List[str]]:
-    """Return the tile IDs that are present in the tile index."""
-    if not isinstance(tile_list, tuple):
-        tile_list = tuple(tile_list)
-        log.debug(f"tile_list was not a tuple, casted to tuple {tile_list}")
+    """Return the tile IDs that are present in the tile index.
 
+    The tile IDs are passed to the query as a single array literal, without a
+    type, so that PostgreSQL casts it to the type of the primary key of the
+    tile index, and the index of the primary key can be used.
+    """
     query_params = {
-        "tiles": sql.Literal(tile_list),
         "index_": tile_index.schema + tile_index.table,
         "tile": tile_index.field.pk.sqlid,
     }
@@ -713,13 +775,14 @@ def tiles_in_index(
         """
     SELECT DISTINCT {tile}
     FROM {index_}
-    WHERE {tile} IN {tiles}
+    WHERE {tile} = ANY(%s)
     """
     ).format(**query_params)
     log.debug(conn.print_query(query))
-    # FIXME: should create a tuple here or not? see also 'with_list'
-    in_index = [t[0] for t in conn.get_query(query)]
-    not_found = set(tile_list) - set(in_index)
+    tile_ids = [str(tile) for tile in tile_list]
+    in_index = [t[0] for t in
+                conn.get_query(query, (_array_literal(tile_ids),))]
+    not_found = set(tile_ids) - set(str(t) for t in in_index)
     if len(not_found) > 0:
         log.warning(
             f"The provided tile IDs {not_found} are not in the index, "
@@ -728,6 +791,13 @@ def tiles_in_index(
     return in_index
 
 
+def _array_literal(values: Sequence[str]) -> str:
+    """Format strings as a PostgreSQL array literal, eg. '{"a","b"}'."""
+    elements = ('"' + v.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                for v in values)
+    return "{" + ",".join(elements) + "}"
+
+
 def all_in_index(conn: db.Db, tile_index: db.Schema) -> List[str]:
     """Get all tile IDs from the tile index."""
     query_params = {
@@ -745,32 +815,119 @@ def all_in_index(conn: db.Db, tile_index: db.Schema) -> List[str]:
 
 def parse_polygonz(wkt_polygonz):
     """Parses a POLYGON Z array of WKT into CityJSON Surface"""
-    # match: 'POLYGON Z (<match everything in here>)'
-    outer_pat = re.compile(r"(?<=POLYGON Z \().*(?!$)")
-    # match: '(<match everything in here>)'
-    ring_pat = re.compile(r"\(([^)]+)\)")
-    outer = outer_pat.findall(wkt_polygonz)
-    if len(outer) > 0:
-        rings = ring_pat.findall(outer[0])
-        for ring in rings:
-            pts = [tuple(map(float, pt.split())) for pt in ring.split(",")]
-            yield pts[1:]  # WKT repeats the first vertex
-    else:
+    # scan: 'POLYGON Z (<everything in here>)'
+    start = wkt_polygonz.find("POLYGON Z (")
+    if start < 0:
         log.error("Not a POLYGON Z")
+        return
+    pos = start + len("POLYGON Z (")
+    # scan: '(<each ring in here>)'
+    ring_start = wkt_polygonz.find("(", pos)
+    while ring_start >= 0:
+        ring_end = wkt_polygonz.find(")", ring_start)
+        if ring_end < 0:
+            break
+        pts = [tuple(map(float, pt.split()))
+               for pt in wkt_polygonz[ring_start + 1:ring_end].split(",")]
+        yield pts[1:]  # WKT repeats the first vertex
+        ring_start = wkt_polygonz.find("(", ring_end)
+
+
+# WKB readers for the two byte orders, indexed by the byte order flag
+_WKB_UINT = (struct.Struct(">I"), struct.Struct("<I"))
+_WKB_POINTZ = (struct.Struct(">3d"), struct.Struct("<3d"))
+
+
+def parse_wkb_multipolygonz(wkb) -> List:
+    """Parses a (MULTI)POLYGON Z WKB into a CityJSON MultiSurface boundary.
+
+    The WKB is read in a single forward pass. The vertices are returned as tuples
+    so that they can be hashed directly when the geometry is referenced. The
+    first vertex of each ring is skipped, because WKB repeats it at the end of
+    the ring.
+
+    :param wkb: The WKB (or EWKB) of a Polygon Z or MultiPolygon Z, for example
+        as returned by ``ST_AsBinary``
+    :return: A list of surfaces, where each surface is a list of rings
+    """
+    # psycopg2 returns bytea as a memoryview of chars, but the WKB is read as
+    # unsigned bytes
+    buf = memoryview(wkb).cast("B")
+    byteorder, geomtype, offset = _wkb_header(buf, 0)
+    if geomtype == 3:
+        surface, offset = _wkb_polygon(buf, offset, byteorder)
+        return [surface, ]
+    elif geomtype == 6:
+        nr_polygons = _WKB_UINT[byteorder].unpack_from(buf, offset)[0]
+        offset += 4
+        multisurface = []
+        for _ in range(nr_polygons):
+            byteorder, geomtype, offset = _wkb_header(buf, offset)
+            surface, offset = _wkb_polygon(buf, offset, byteorder)
+            multisurface.append(surface)
+        return multisurface
+    else:
+        raise ValueError(f"WKB geometry type {geomtype} is not a Polygon or "
+                         f"MultiPolygon")
+
+
+def _wkb_header(buf: memoryview, offset: int) -> Tuple[int, int, int]:
+    """Read the byte order and the geometry type of a WKB geometry.
+
+    Both the ISO (eg. 1003 for Polygon Z) and the PostGIS extended (EWKB) type
+    codes are accepted.
+
+    :return: (byte order, 2D geometry type, offset of the geometry data)
+    """
+    byteorder = buf[offset]
+    wkb_type = _WKB_UINT[byteorder].unpack_from(buf, offset + 1)[0]
+    offset += 5
+    if wkb_type & 0x20000000:
+        # EWKB with an embedded SRID
+        offset += 4
+    iso_type = wkb_type & 0x0FFFFFFF
+    if (wkb_type & 0xC0000000) != 0x80000000 and iso_type // 1000 != 1:
+        raise ValueError(f"WKB geometry type {wkb_type} does not have exactly "
+                         f"three dimensions (XYZ)")
+    return byteorder, iso_type % 1000, offset
+
+
+def _wkb_polygon(buf: memoryview, offset: int, byteorder: int) -> Tuple[List, int]:
+    """Read the rings of a WKB Polygon Z, starting after its header."""
+    uint = _WKB_UINT[byteorder]
+    pointz = _WKB_POINTZ[byteorder]
+    nr_rings = uint.unpack_from(buf, offset)[0]
+    offset += 4
+    surface = []
+    for _ in range(nr_rings):
+        nr_points = uint.unpack_from(buf, offset)[0]
+        offset += 4
+        end = offset + nr_points * pointz.size
+        # Skip the first vertex, because it is repeated at the end of the ring
+        surface.append(list(pointz.iter_unpack(buf[offset + pointz.size:end])))
+        offset = end
+    return surface, offset
 
 
 def sql_cast_geometry(features: db.Schema) -> sql.Composed:
     """Create a clause for SELECT statements for the geometry columns.
 
     For each geometry column in the table (one column per LoD) that is mapped in
-    the configuration file, prepare the clauses for the SELECT statement.
+    the configuration file, prepare the clauses for the SELECT statement. The
+    geometry is returned as WKB, which is parsed into a CityJSON-like boundary
+    array by :func:`parse_wkb_multipolygonz`. The repeated points are removed
+    in the database, so that they are not transferred and parsed. The WKB is
+    requested in little-endian (NDR) byte order, regardless of the server.
 
     :return: An SQL snippent for example:
-        'cjdb_multipolygon_to_multisurface(wkb_geometry_lod1) geom_lod1,
-         cjdb_multipolygon_to_multisurface(wkb_geometry_lod2) geom_lod2'
+        'ST_AsBinary(ST_RemoveRepeatedPoints(wkb_geometry_lod1), 'NDR') geom_lod1,
+         ST_AsBinary(ST_RemoveRepeatedPoints(wkb_geometry_lod2), 'NDR') geom_lod2'
     """
     lod_fields = [
-        sql.SQL("cjdb_multipolygon_to_multisurface({geom_field}) {geom_alias}").format(
+        sql.SQL(
+            "ST_AsBinary(ST_RemoveRepeatedPoints({geom_field}), 'NDR') "
+            "{geom_alias}"
+        ).format(
             geom_field=getattr(features.field.geometry, lod).name.sqlid,
             geom_alias=sql.Identifier(settings.geom_prefix + lod),
         )
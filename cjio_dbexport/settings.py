@@ -24,4 +24,12 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 # Prefix for geometry column names and aliases
-geom_prefix = 'geom_'
\ No newline at end of file
+geom_prefix = 'geom_'
+# Number of records that are fetched at once when streaming a query result
+itersize = 10000
+# Run-time parameters of PostgreSQL that are SET LOCAL for the query of a tile,
+# so that the planner can use parallel workers for it
+tile_query_settings = {
+    'max_parallel_workers_per_gather': '4',
+    'parallel_tuple_cost': '0',
+}
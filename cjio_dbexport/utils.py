@@ -25,47 +25,72 @@ SOFTWARE.
 """
 import json
 import math
+from functools import lru_cache
+from itertools import chain, islice
 from statistics import mean
-from typing import Iterable, Tuple, Mapping, TextIO, Union
+from typing import Iterable, Iterator, List, Tuple, Mapping, TextIO, Union
 import logging
 import zipfile, gzip
 from platform import platform
 from pathlib import Path
 
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logging.getLogger(__name__)
 
 def create_rectangle_grid(bbox: Iterable[float], hspacing: float,
-                          vspacing: float) -> Iterable:
+                          vspacing: float) -> np.ndarray:
     """
 
     :param bbox: (xmin, ymin, xmax, ymax)
     :param hspacing:
     :param vspacing:
-    :return: A MultiPolygon of rectangular polygons (the grid) as Simple Feature
+    :return: A MultiPolygon of rectangular polygons (the grid) as Simple
+        Feature, as an array of shape (cells, 1, 5, 2)
     """
     xmin, ymin, xmax, ymax = bbox
     width = math.ceil(xmax - xmin)
     height = math.ceil(ymax - ymin)
     cols = math.ceil(width / hspacing)
     rows = math.ceil(height / vspacing)
-    multipolygon = list()
+    _, _, rings = _grid_rings(xmin, ymax, cols, rows, hspacing, vspacing)
+    # Polygons with a single (outer) ring
+    return rings.reshape(-1, 1, 5, 2)
 
-    for col in range(cols):
-        x1 = float(xmin) + (col * hspacing)
-        x2 = x1 + hspacing
 
-        for row in range(rows):
-            y1 = float(ymax) - (row * vspacing)
-            y2 = y1 - vspacing
+def _grid_rings(xmin: float, ymax: float, cols: int, rows: int,
+                hspacing: float, vspacing: float) -> Tuple[np.ndarray, ...]:
+    """Compute the rings of the cells of a rectangular grid.
 
-            # A polygon with a single (outer) ring
-            polygon = [[(x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)]]
-            multipolygon.append(polygon)
+    The grid starts in the upper-left corner (xmin, ymax) and the cells are
+    ordered column-by-column, from top to bottom.
 
-    return multipolygon
+    :returns: The x-coordinate of the left side of each column, the
+        y-coordinate of the upper side of each row and the rings of the cells
+        as an array of shape (cols, rows, 5, 2)
+    """
+    x1 = float(xmin) + np.arange(cols) * hspacing
+    x2 = x1 + hspacing
+    y1 = float(ymax) - np.arange(rows) * vspacing
+    y2 = y1 - vspacing
+    # Fill the vertices of the rings into a single array, without temporary
+    # arrays of the whole grid
+    rings = np.empty((cols, rows, 5, 2), dtype=np.float64)
+    # [(x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)]
+    corners = ((x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1))
+    for i, (x, y) in enumerate(corners):
+        rings[:, :, i, 0] = x[:, np.newaxis]
+        rings[:, :, i, 1] = y
+    return x1, y1, rings
 
 def create_rectangle_grid_morton(bbox: Iterable[float], hspacing: float,
-                                 vspacing: float) -> Mapping:
+                                 vspacing: float, as_dict: bool = False
+                                 ) -> Union[Tuple[np.ndarray, np.ndarray],
+                                            Mapping]:
     """Creates a grid of rectangular polygons and computes their Morton code.
 
     If the width or height of the ``bbox`` is not divisible by 4 without a
@@ -76,9 +101,23 @@ def create_rectangle_grid_morton(bbox: Iterable[float], hspacing: float,
     :param bbox: (xmin, ymin, xmax, ymax)
     :param hspacing: Width of a cell
     :param vspacing: Height of a cell
-    :return: A dictionary of {morton code: Polygon}. Polygon is represented as
-        Simple Feature.
+    :param as_dict: Return the grid as a dictionary of {morton code: Polygon}
+    :return: A tuple of (morton codes, polygons), sorted by the morton code.
+        The codes are an uint64 array and the polygons are represented as
+        Simple Feature, as an array of shape (cells, 1, 5, 2). The grids are
+        cached, therefore the arrays are read-only.
     """
+    codes, polygons = _rectangle_grid_morton(tuple(bbox), hspacing, vspacing)
+    if as_dict:
+        return dict(zip(codes.tolist(), polygons))
+    return codes, polygons
+
+
+@lru_cache(maxsize=8)
+def _rectangle_grid_morton(bbox: Tuple[float, float, float, float],
+                           hspacing: float,
+                           vspacing: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute the grid of :py:func:`create_rectangle_grid_morton`."""
     xmin, ymin, xmax, ymax = bbox
     width = math.ceil(xmax - xmin)
     height = math.ceil(ymax - ymin)
@@ -90,32 +129,26 @@ def create_rectangle_grid_morton(bbox: Iterable[float], hspacing: float,
         rows += cols - rows
     elif cols < rows:
         cols += rows - cols
-    # Expand extent until we get enough cells for a full quadtree
-    exponent = math.ceil(math.log(rows*cols, 4))
-    full_cells = 4**exponent
-    rows = int(math.sqrt(full_cells))
-    cols = int(math.sqrt(full_cells))
-    grid = dict()
-
-
-    for col in range(cols):
-        x1 = float(xmin) + (col * hspacing)
-        x2 = x1 + hspacing
-
-        for row in range(rows):
-            y1 = float(ymax) - (row * vspacing)
-            y2 = y1 - vspacing
-
-            ring = [(x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)]
-            # A polygon with a single (outer) ring
-            polygon = [ring,]
-
-            centroid = mean_coordinate(ring)
-            morton_key = morton_code(*centroid)
-
-            grid[morton_key] = polygon
-
-    return dict((k, grid[k]) for k in sorted(grid))
+    # Expand extent until we get enough cells for a full quadtree, thus
+    # 4**exponent cells, with the smallest exponent that fits rows*cols
+    exponent = ((rows*cols - 1).bit_length() + 1) // 2
+    rows = 1 << exponent
+    cols = 1 << exponent
+    x1, y1, rings = _grid_rings(xmin, ymax, cols, rows, hspacing, vspacing)
+    # The centroid of a cell is the mean of the five vertices of its ring, as
+    # in mean_coordinate. It is computed (exactly) once per column and row.
+    cx = [mean((x, x, x + hspacing, x + hspacing, x)) for x in x1.tolist()]
+    cy = [mean((y, y - vspacing, y - vspacing, y, y)) for y in y1.tolist()]
+    cxx, cyy = np.meshgrid(cx, cy, indexing="ij")
+    codes = morton_encode_2d_vec(cxx.ravel(), cyy.ravel())
+    # Polygons with a single (outer) ring
+    polygons = rings.reshape(-1, 1, 5, 2)
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    polygons = polygons[order]
+    codes.setflags(write=False)
+    polygons.setflags(write=False)
+    return codes, polygons
 
 
 def index_quadtree(grid):
@@ -123,16 +156,18 @@ def index_quadtree(grid):
 
     Based on AHN's tile indexing.
 
-    :param grid: A rectangular grid of polygons which has 4**x cells. The cells
-        must be sorted in Morton-order.
+    :param grid: The morton codes of a rectangular grid which has 4**x cells.
+        The codes must be sorted. Either an array of codes or a dictionary
+        of {morton code: Polygon}.
+    :return: A dictionary of {cell ID: morton code}, in the order of ``grid``
     """
-    quadtree = dict()
     nr_cells = len(grid)
-    if not math.log(nr_cells, 4).is_integer():
+    nr_bits = (nr_cells - 1).bit_length()
+    if nr_cells != 1 << nr_bits or nr_bits % 2 != 0:
         raise ValueError(f"There are {nr_cells} in the grid. The grid must "
                          f"contain 4**x cells to form a full quadtree. ")
     # Nr. levels in the quadtree
-    nr_lvls = int(math.log(nr_cells, 4))
+    nr_lvls = nr_bits // 2
     log.debug(f"Nr. levels={nr_lvls}, cells={nr_cells}")
 
     id_map = {
@@ -149,17 +184,22 @@ def index_quadtree(grid):
         for i in range(diff):
             id_map[5+i] = id_map[i]
 
-    # Compose the cell IDs per level
-    for i, mcode in enumerate(grid):
-        cell_id = ""
-        for j in range(nr_lvls, 0, -1):
-            lvl_id = id_map[j-1]
-            lvl_idx = int((i % 4**j) / 4**(j-1))
-            cell_id += lvl_id[lvl_idx]
-        if cell_id in quadtree:
-            raise IndexError(f"ID {cell_id} already exists in the quadtree")
-        else:
-            quadtree[cell_id] = mcode
+    if isinstance(grid, np.ndarray):
+        grid = grid.tolist()
+    # Compose the cell IDs per level. The index of a cell in a level is given
+    # by two bits of the position of the cell in the (Morton-ordered) grid.
+    position = np.arange(nr_cells, dtype=np.int64)
+    lvl_ids = []
+    for j in range(nr_lvls, 0, -1):
+        lvl_idx = (position >> (2 * (j-1))) & 3
+        lvl_ids.append(np.array(id_map[j-1])[lvl_idx].tolist())
+    if lvl_ids:
+        cell_ids = ["".join(cell_id) for cell_id in zip(*lvl_ids)]
+    else:
+        cell_ids = [""] * nr_cells
+    quadtree = dict(zip(cell_ids, grid))
+    if len(quadtree) != nr_cells:
+        raise IndexError("There are duplicate IDs in the quadtree")
 
     return quadtree
 
@@ -167,21 +207,20 @@ def index_quadtree(grid):
 def bbox(polygon: Iterable) -> Tuple[float, float, float, float]:
     """Compute the Bounding Box of a polygon.
 
-    :param polygon: A Simple Feature Polygon, defined as [[[x1, y1], ...], ...]
+    :param polygon: A Simple Feature Polygon, defined as [[[x1, y1], ...], ...].
+        Either an array of shape (rings, vertices, 2), or a sequence of rings,
+        which can have a different number of vertices.
     """
-    x,y = 0,1
-    vtx = polygon[0][0]
-    minx, miny, maxx, maxy = vtx[x], vtx[y], vtx[x], vtx[y]
-    for ring in polygon:
-        for vtx in ring:
-            if vtx[x] < minx:
-                minx = vtx[x]
-            elif vtx[y] < miny:
-                miny = vtx[y]
-            elif vtx[x] > maxx:
-                maxx = vtx[x]
-            elif vtx[y] > maxy:
-                maxy = vtx[y]
+    if isinstance(polygon, np.ndarray):
+        vertices = polygon.reshape(-1, polygon.shape[-1])[:, :2]
+    elif all(isinstance(ring, np.ndarray) for ring in polygon):
+        vertices = np.concatenate([ring[:, :2] for ring in polygon])
+    else:
+        # Sequences of coordinates, the reductions run in C on the tuples
+        xs, ys = tuple(zip(*chain.from_iterable(polygon)))[:2]
+        return min(xs), min(ys), max(xs), max(ys)
+    minx, miny = vertices.min(axis=0).tolist()
+    maxx, maxy = vertices.max(axis=0).tolist()
     return minx, miny, maxx, maxy
 
 
@@ -255,6 +294,10 @@ def __unpart1by1_64(n):
     return n
 
 
+# The bits of each byte spread to the even bits of 16 bits, see morton_code
+_PART1BY1_8 = tuple(__part1by1_64(i) for i in range(256))
+
+
 def interleave(*args):
     """Interleave two integers to create a Morton key."""
     if len(args) != 2:
@@ -280,40 +323,162 @@ def morton_code(x: float, y: float):
     """Takes an (x,y) coordinate tuple and computes their Morton-key.
 
     Casts float to integers by multiplying them with 100 (millimeter precision).
+    The integers are interleaved byte-by-byte from a lookup table. For arrays
+    of coordinates use :func:`morton_encode_2d_vec`.
     """
-    return interleave(int(x * 100), int(y * 100))
+    t = _PART1BY1_8
+    xi = int(x * 100) & 0xffffffff
+    yi = int(y * 100) & 0xffffffff
+    xs = (t[xi & 0xff] | t[(xi >> 8) & 0xff] << 16 |
+          t[(xi >> 16) & 0xff] << 32 | t[xi >> 24] << 48)
+    ys = (t[yi & 0xff] | t[(yi >> 8) & 0xff] << 16 |
+          t[(yi >> 16) & 0xff] << 32 | t[yi >> 24] << 48)
+    return xs | (ys << 1)
 
 
 def rev_morton_code(morton_key: int) -> Tuple[float, float]:
-    """Get the coordinates from a Morton-key"""
-    x,y = deinterleave(morton_key)
-    return float(x)/100.0, float(y)/100.0
+    """Get the coordinates from a Morton-key
+
+    The bits of x and y are compacted together, as the low and high 64 bits of
+    the same integer, with the masks of ``__unpart1by1_64`` repeated twice.
+    """
+    n = ((morton_key & 0x5555555555555555) |
+         ((morton_key >> 1) & 0x5555555555555555) << 64)
+    n = (n ^ (n >> 1)) & 0x33333333333333333333333333333333
+    n = (n ^ (n >> 2)) & 0x0f0f0f0f0f0f0f0f0f0f0f0f0f0f0f0f
+    n = (n ^ (n >> 4)) & 0x00ff00ff00ff00ff00ff00ff00ff00ff
+    n = (n ^ (n >> 8)) & 0x0000ffff0000ffff0000ffff0000ffff
+    n = (n ^ (n >> 16)) & 0x00000000ffffffff00000000ffffffff
+    return (n & 0xffffffff) / 100.0, (n >> 64) / 100.0
+
+
+def _part1by1_64_vec(n: np.ndarray) -> np.ndarray:
+    """64-bit mask, same as ``__part1by1_64`` on an array of uint64.
+
+    The array is modified in place, to avoid a temporary array per operation.
+    """
+    shifted = np.empty_like(n)
+    n &= np.uint64(0x00000000ffffffff)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        np.left_shift(n, np.uint64(shift), out=shifted)
+        n |= shifted
+        n &= np.uint64(mask)
+    return n
+
+
+def morton_encode_2d_vec(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Computes the Morton-key of arrays of x- and y-coordinates.
+
+    Same as :func:`morton_code`, but the bits of all the coordinates are
+    interleaved at once with numpy.
+
+    :returns: An array of uint64 Morton-keys
+    """
+    xi = np.trunc(np.asarray(x, dtype=np.float64) * 100).astype(np.int64)
+    yi = np.trunc(np.asarray(y, dtype=np.float64) * 100).astype(np.int64)
+    keys = _part1by1_64_vec(xi.view(np.uint64))
+    keys |= _part1by1_64_vec(yi.view(np.uint64)) << np.uint64(1)
+    return keys
+
+
+def _unpart1by1_64_vec(n: np.ndarray) -> np.ndarray:
+    """Same as ``__unpart1by1_64`` on an array of uint64, in place."""
+    shifted = np.empty_like(n)
+    n &= np.uint64(0x5555555555555555)
+    for shift, mask in ((1, 0x3333333333333333), (2, 0x0f0f0f0f0f0f0f0f),
+                        (4, 0x00ff00ff00ff00ff), (8, 0x0000ffff0000ffff),
+                        (16, 0x00000000ffffffff)):
+        np.right_shift(n, np.uint64(shift), out=shifted)
+        n ^= shifted
+        n &= np.uint64(mask)
+    return n
+
 
+def morton_decode_2d_vec(morton_keys: np.ndarray) -> np.ndarray:
+    """Get the coordinates from an array of Morton-keys.
 
-def read_geojson_polygon(fo: TextIO) -> Iterable:
+    Same as :func:`rev_morton_code`, but for all the keys at once.
+
+    :returns: An array of (x, y) coordinates, of shape (keys, 2)
+    """
+    keys = np.asarray(morton_keys, dtype=np.uint64)
+    coords = np.empty((keys.shape[0], 2), dtype=np.float64)
+    coords[:, 0] = _unpart1by1_64_vec(keys.copy())
+    coords[:, 1] = _unpart1by1_64_vec(keys >> np.uint64(1))
+    coords /= 100.0
+    return coords
+
+
+def read_geojson_polygon(fo: TextIO) -> List[np.ndarray]:
     """Reads a single polygon from a GeoJSON file.
-    :returns: A Simple Feature representation of the polygon
+    :returns: A Simple Feature representation of the polygon, as a list of
+        rings. Each ring is an array of shape (vertices, dimensions), because
+        the rings can have a different number of vertices.
     """
     polygon = list()
     # Only Polygon is allowed (no Multi-)
-    gjson = json.load(fo)
+    if orjson is not None:
+        gjson = orjson.loads(fo.read())
+    else:
+        gjson = json.load(fo)
     if gjson['features'][0]['geometry']['type'] != 'Polygon':
         raise ValueError(f"The first Feature in GeoJSON is "
                          f"{gjson['features'][0]['geometry']['type']}. Only "
                          f"Polygon is allowed.")
     else:
-        polygon = gjson['features'][0]['geometry']['coordinates']
+        polygon = [np.asarray(ring, dtype=np.float64) for ring in
+                   gjson['features'][0]['geometry']['coordinates']]
     return polygon
 
 
+def batched(iterable: Iterable, n: int) -> Iterator[List]:
+    """Split an iterable into lists of ``n`` elements, the last one can be
+    shorter."""
+    if n < 1:
+        raise ValueError("The batch size must be at least 1")
+    it = iter(iterable)
+    batch = list(islice(it, n))
+    while batch:
+        yield batch
+        batch = list(islice(it, n))
+
+
 def to_ewkt(polygon, srid) -> str:
     """Creates a WKT representation of a Simple Feature polygon.
+
+    Only the exterior ring of the polygon is written. The ring can be an
+    array, then it is converted to Python floats at once, before formatting.
     :returns: The WKT string of ``polygon``
     """
-    ring = [" ".join(map(str, i)) for i in polygon[0]]
-    ewkt = f'SRID={srid};POLYGON(({",".join(ring)}))'
+    exterior = polygon[0]
+    if isinstance(exterior, np.ndarray):
+        exterior = exterior.tolist()
+    if all(len(vtx) == 2 for vtx in exterior):
+        ring = ",".join([f"{x} {y}" for x, y in exterior])
+    else:
+        ring = ",".join([" ".join(map(str, vtx)) for vtx in exterior])
+    ewkt = f'SRID={srid};POLYGON(({ring}))'
     return ewkt
 
+def grid_to_ewkt(polygons: np.ndarray, srid) -> List[str]:
+    """Creates the WKT representation of each cell of a grid.
+
+    Same as :py:func:`to_ewkt` for each polygon, but the coordinates of all
+    the cells are converted to strings at once.
+
+    :param polygons: The cells of the grid, as an array of shape
+        (cells, rings, vertices, dimensions)
+    :returns: The WKT strings of the ``polygons``
+    """
+    exteriors = polygons[:, 0]
+    nr_vertices, nr_dims = exteriors.shape[1:]
+    coords = iter(map(str, exteriors.ravel().tolist()))
+    vertices = iter([" ".join(vtx) for vtx in zip(*[coords] * nr_dims)])
+    return [f'SRID={srid};POLYGON(({",".join(ring)}))'
+            for ring in zip(*[vertices] * nr_vertices)]
+
 def lod_to_string(lod: Union[int, float]) -> Union[str, None]:
     """Convert and LoD integer or float to string.
     """
@@ -345,6 +510,18 @@ def parse_lod_value(lod_key: str) -> str:
         raise ValueError(f"Invalid LoD value '{value}' in key {lod_key}")
 
 
+def dumps_json(obj) -> bytes:
+    """Serialize an object to compact, UTF-8 encoded JSON.
+
+    Uses `orjson <https://github.com/ijl/orjson>`_ if it is installed, which
+    is several times faster than the standard library on the large, numeric
+    CityJSON objects, otherwise falls back to :func:`json.dumps`.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(',', ':')).encode("utf-8")
+
+
 def write_zip(data: bytes, filename: str, outdir: Path):
     """Write out a citymodel to a zip file.
 
@@ -364,4 +541,93 @@ def write_zip(data: bytes, filename: str, outdir: Path):
         outzip = outfile.with_suffix(".json.gz")
         with gzip.open(outzip, "w") as zout:
             zout.write(data)
-    return outzip
\ No newline at end of file
+    return outzip
+
+
+def compress(j: dict, important_digits: int = 3) -> bool:
+    """Quantize the vertices of a CityJSON object in place, as cjio's
+    ``CityJSON.compress``, then clean them with :func:`clean_vertices`."""
+    if "transform" in j:
+        return False
+    vertices = np.asarray(j["vertices"], dtype=np.float64).reshape(-1, 3)
+    if len(vertices) > 0:
+        translate = vertices.min(axis=0)
+    else:
+        translate = np.zeros(3)
+    quantized = np.rint((vertices - translate) * 10 ** important_digits)
+    if len(quantized) == 0 or quantized.max() <= np.iinfo(np.int32).max:
+        quantized = quantized.astype(np.int32)
+    else:
+        quantized = quantized.astype(np.int64)
+    scale = float(f"1e-{important_digits}")
+    j["transform"] = {
+        "scale": [scale, scale, scale],
+        "translate": translate.tolist()
+    }
+    j["vertices"] = quantized
+    clean_vertices(j)
+    return True
+
+
+def clean_vertices(j: dict, precision: int = 3) -> Tuple[int, int]:
+    """Remove the duplicate and orphan vertices of a CityJSON object in place
+    and update its extent. Returns the nr. of removed duplicates and orphans."""
+    if len(j["vertices"]) == 0:
+        j["vertices"] = []
+        return 0, 0
+    vertices = np.asarray(j["vertices"])
+    if "transform" not in j:
+        rounded = vertices.round(precision)
+    else:
+        rounded = vertices
+    boundaries = [geom["boundaries"] for co in j["CityObjects"].values()
+                  for geom in co.get("geometry", [])]
+    indices = []
+    for boundary in boundaries:
+        _collect_indices(boundary, indices)
+    unique, first_index, inverse = np.unique(rounded, axis=0,
+                                             return_index=True,
+                                             return_inverse=True)
+    # The unique vertex of each index in the boundaries
+    used = inverse.ravel()[np.asarray(indices, dtype=np.int64)]
+    # The used unique vertices, in the order of their first use
+    kept, first = np.unique(used, return_index=True)
+    kept = kept[np.argsort(first)]
+    newids = np.empty(len(unique), dtype=np.int64)
+    newids[kept] = np.arange(len(kept))
+    newids_iter = iter(newids[used].tolist())
+    for boundary in boundaries:
+        _replace_indices(boundary, newids_iter)
+    vertices_kept = vertices[first_index][kept]
+    j["vertices"] = vertices_kept.tolist()
+    if len(vertices_kept) > 0:
+        bbox = np.concatenate((vertices_kept.min(axis=0),
+                               vertices_kept.max(axis=0)))
+        if "transform" in j:
+            scale = j["transform"]["scale"]
+            translate = j["transform"]["translate"]
+            bbox = bbox * (scale + scale) + (translate + translate)
+        extent = bbox.tolist()
+    else:
+        extent = [0, 0, 0, 0, 0, 0]
+    j.setdefault("metadata", {})["geographicalExtent"] = extent
+    return len(vertices) - len(unique), len(unique) - len(kept)
+
+
+def _collect_indices(boundaries: list, indices: list):
+    """Append the vertex indices of a nested boundary array to ``indices``."""
+    for each in boundaries:
+        if isinstance(each, list):
+            _collect_indices(each, indices)
+        else:
+            indices.append(each)
+
+
+def _replace_indices(boundaries: list, newids: Iterator[int]):
+    """Replace the vertex indices of a nested boundary array in place, with the
+    next values of ``newids``."""
+    for i, each in enumerate(boundaries):
+        if isinstance(each, list):
+            _replace_indices(each, newids)
+        else:
+            boundaries[i] = next(newids)
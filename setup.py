@@ -14,7 +14,8 @@ requirements = [
     'Click>=7.0',
     'psycopg2>=2.8',
     'PyYAML>=5.1.2',
-    'cjio >= 0.6.0'
+    'cjio >= 0.6.0',
+    'numpy'
 ]
 
 setup_requirements = ['pytest-runner', ]
@@ -42,6 +43,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={'orjson': ['orjson']},
     license="MIT license",
     long_description=readme + '\n\n' + changelog,
     include_package_data=True,
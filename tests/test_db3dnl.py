@@ -4,6 +4,8 @@
 import logging
 import pickle
 import json
+import struct
+from datetime import date, datetime, timedelta
 from concurrent.futures import as_completed, ThreadPoolExecutor
 
 import pytest
@@ -14,6 +16,109 @@ from cjio_dbexport import db3dnl, db, utils
 log = logging.getLogger(__name__)
 
 
+def wkb_polygonz(rings, byteorder='<', wkb_type=1003):
+    """Pack the rings of a polygon into a WKB Polygon Z"""
+    flag = b'\x01' if byteorder == '<' else b'\x00'
+    wkb = flag + struct.pack(f"{byteorder}II", wkb_type, len(rings))
+    for ring in rings:
+        wkb += struct.pack(f"{byteorder}I", len(ring))
+        for vtx in ring:
+            wkb += struct.pack(f"{byteorder}3d", *vtx)
+    return wkb
+
+
+@pytest.mark.parametrize('attr, expect', [
+    (1.23456, 1.2346),
+    (date(2020, 1, 22), '2020-01-22'),
+    (datetime(2020, 1, 22, 10, 30), '2020-01-22T10:30:00'),
+    (timedelta(hours=1), '1:00:00'),
+    (None, None),
+    ('a', 'a'),
+    (7, 7)
+])
+def test_parse_attribute(attr, expect):
+    assert db3dnl.parse_attribute(attr, rounding=4) == expect
+
+
+def test_array_literal():
+    assert db3dnl._array_literal(['gb2', '1', 'a"b', 'c\\d']) == \
+           '{"gb2","1","a\\"b","c\\\\d"}'
+    assert db3dnl._array_literal([]) == '{}'
+
+
+class StubConn:
+    """Returns the records of the tiles in a batch, as Db.get_dict."""
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.batches = []
+
+    def get_dict(self, query, params=None, local_settings=None):
+        batch, = params
+        self.batches.append(batch)
+        return [dict(record) for tile in batch for record in self.tiles[tile]]
+
+
+def test_query_tile_batches():
+    tiles = {
+        't1': [{'pk': 1}, {'pk': 2}],
+        't2': [{'pk': 2}, {'pk': 3}],
+        't3': [{'pk': 3}],
+        't4': [{'pk': 1}, {'pk': 4}]
+    }
+    conn = StubConn(tiles)
+    records = db3dnl.query_tile_batches(conn, 'EXECUTE q(%s);',
+                                        list(tiles), tile_batch_size=1)
+    # Only the first batch is queried until the records are consumed
+    assert conn.batches == [['t1']]
+    assert [record['pk'] for record in records] == [1, 2, 3, 4]
+    assert conn.batches == [['t1'], ['t2'], ['t3'], ['t4']]
+
+
+def test_query_tile_batches_empty():
+    conn = StubConn({})
+    assert list(db3dnl.query_tile_batches(conn, 'EXECUTE q(%s);', [])) == []
+    assert conn.batches == []
+
+
+class TestGeometryParsing:
+    def test_parse_polygonz(self):
+        polyz = 'POLYGON Z ((0 0 1,1 0 1,1 1 1,0 0 1), (2 2 2,3 3 3,2 2 2))'
+        surface = list(db3dnl.parse_polygonz(polyz))
+        assert surface == [[(1.0, 0.0, 1.0), (1.0, 1.0, 1.0), (0.0, 0.0, 1.0)],
+                           [(3.0, 3.0, 3.0), (2.0, 2.0, 2.0)]]
+
+    @pytest.mark.parametrize('byteorder', ['<', '>'])
+    def test_parse_wkb_polygonz(self, byteorder):
+        exterior = [(0.0, 0.0, 1.0), (1.0, 0.0, 1.0), (1.0, 1.0, 1.0),
+                    (0.0, 0.0, 1.0)]
+        wkb = wkb_polygonz([exterior], byteorder=byteorder)
+        assert db3dnl.parse_wkb_multipolygonz(wkb) == [[exterior[1:]]]
+
+    def test_parse_wkb_multipolygonz(self):
+        exterior = [(0.0, 0.0, 1.0), (1.0, 0.0, 1.0), (1.0, 1.0, 1.0),
+                    (0.0, 0.0, 1.0)]
+        interior = [(0.2, 0.1, 1.0), (0.8, 0.1, 1.0), (0.8, 0.7, 1.0),
+                    (0.2, 0.1, 1.0)]
+        polygon_1 = wkb_polygonz([exterior, interior])
+        polygon_2 = wkb_polygonz([exterior], byteorder='>')
+        wkb = b'\x01' + struct.pack('<II', 1006, 2) + polygon_1 + polygon_2
+        msurface = db3dnl.parse_wkb_multipolygonz(memoryview(wkb).cast('c'))
+        assert msurface == [[exterior[1:], interior[1:]], [exterior[1:]]]
+
+    def test_parse_wkb_memoryview(self):
+        """psycopg2 returns a bytea column as a memoryview of chars"""
+        exterior = [(0.0, 0.0, 1.0), (1.0, 0.0, 1.0), (1.0, 1.0, 1.0),
+                    (0.0, 0.0, 1.0)]
+        wkb = memoryview(wkb_polygonz([exterior])).cast('c')
+        assert wkb.format == 'c'
+        assert db3dnl.parse_wkb_multipolygonz(wkb) == [[exterior[1:]]]
+
+    def test_parse_wkb_not_3d(self):
+        wkb = wkb_polygonz([[(0.0, 0.0, 0.0)]], wkb_type=3)
+        with pytest.raises(ValueError):
+            db3dnl.parse_wkb_multipolygonz(wkb)
+
+
 @pytest.mark.db3dnl
 class TestParsing:
     def test_parse_boundary(self):
@@ -107,7 +212,7 @@ class TestIntegration:
                                   cityobject_type=cfg_db3dnl[
                                       'cityobject_type'],
                                   tile_list=['gb2', 'ic1', 'ic2', 'ec4'])
-        dbexport = list(export_gen)
+        dbexport = [(coinfo, list(records)) for coinfo, records in export_gen]
         with open(db3dnl_4tiles_pickle, 'wb') as fo:
             pickle.dump(dbexport, fo)
 
@@ -213,9 +318,9 @@ class TestIntegration:
         tilesize = (10000, 10000)
         polygon = cjio_dbexport.utils.read_geojson_polygon(nl_poly)
         bbox = utils.bbox(polygon)
-        grid = utils.create_rectangle_grid_morton(bbox=bbox,
-                                                  hspacing=tilesize[0],
-                                                  vspacing=tilesize[1])
+        codes, grid = utils.create_rectangle_grid_morton(bbox=bbox,
+                                                         hspacing=tilesize[0],
+                                                         vspacing=tilesize[1])
         log.info(f"Nr. of tiles={len(grid)}")
 
     # def test_save(self, data_dir):
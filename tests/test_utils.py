@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 """Testing the utils module"""
+import json
 import logging
-import math
+import numpy as np
 import pytest
 from pathlib import Path
 from cjio_dbexport import utils
@@ -13,6 +14,14 @@ class TestGeom:
         polygon = utils.read_geojson_polygon(nl_poly)
         assert len(polygon) > 0
 
+    def test_read_geojson_polygon_json(self, nl_poly_path, monkeypatch):
+        with open(nl_poly_path, 'r') as fo:
+            expect = utils.read_geojson_polygon(fo)
+        monkeypatch.setattr(utils, "orjson", None)
+        with open(nl_poly_path, 'r') as fo:
+            polygon = utils.read_geojson_polygon(fo)
+        assert all(np.array_equal(r, e) for r, e in zip(polygon, expect))
+
     def test_read_geojson_polygon_multi(self, nl_multi):
         with pytest.raises(ValueError):
             polygon = utils.read_geojson_polygon(nl_multi)
@@ -23,6 +32,18 @@ class TestGeom:
         ewkt = utils.to_ewkt(polygon, srid=7415)
         assert ewkt == expect
 
+    def test_to_ewkt_3d(self):
+        polygon = [[(0.0, 0.0, 1.0), (1.0, 1.0, 2.0), (1.0, 0.0, 1.5),
+                    (0.0, 0.0, 1.0)]]
+        expect = 'SRID=7415;POLYGON((0.0 0.0 1.0,1.0 1.0 2.0,1.0 0.0 1.5,' \
+                 '0.0 0.0 1.0))'
+        assert utils.to_ewkt(polygon, srid=7415) == expect
+
+    def test_to_ewkt_array(self):
+        polygon = np.array([[(0.0, 0.0), (1.0, 1.0), (1.0, 0.0), (0.0, 0.0)]])
+        expect = 'SRID=7415;POLYGON((0.0 0.0,1.0 1.0,1.0 0.0,0.0 0.0))'
+        assert utils.to_ewkt(polygon, srid=7415) == expect
+
     def test_to_ewkt_nl(self, nl_poly):
         polygon = utils.read_geojson_polygon(nl_poly)
         ewkt = utils.to_ewkt(polygon, srid=7415)
@@ -30,16 +51,31 @@ class TestGeom:
 
     def test_to_ewkt_grid(self, nl_poly):
         bbox = (1032.05, 286175.81, 304847.26, 624077.50)
-        grid = utils.create_rectangle_grid_morton(bbox=bbox, hspacing=10000,
-                                                  vspacing=10000)
-        for code, poly in grid.items():
+        codes, grid = utils.create_rectangle_grid_morton(bbox=bbox,
+                                                         hspacing=10000,
+                                                         vspacing=10000)
+        for poly in grid:
             ewkt = utils.to_ewkt(poly, srid=7415)
             log.debug(ewkt)
 
+    def test_grid_to_ewkt(self):
+        bbox = (1032.05, 286175.81, 304847.26, 624077.50)
+        codes, grid = utils.create_rectangle_grid_morton(bbox=bbox,
+                                                         hspacing=10000,
+                                                         vspacing=10000)
+        expect = [utils.to_ewkt(poly, srid=7415) for poly in grid]
+        assert utils.grid_to_ewkt(grid, srid=7415) == expect
+
 class TestBBOX:
     @pytest.mark.parametrize('polygon, bbox', [
         [[[(1.0, 4.0), (3.0,1.0), (6.0, 2.0), (6.0, 6.0), (2.0, 7.0)]], (1.0, 1.0, 6.0, 7.0)],
-        [[[(1.0, 4.0), (3.0,1.0), (6.0, 2.0), (6.0, 6.0), (2.0, 7.0), (1.0, 4.0)]], (1.0, 1.0, 6.0, 7.0)]
+        [[[(1.0, 4.0), (3.0,1.0), (6.0, 2.0), (6.0, 6.0), (2.0, 7.0), (1.0, 4.0)]], (1.0, 1.0, 6.0, 7.0)],
+        [[[(3.0, 1.0), (1.0, 4.0), (2.0, 7.0), (6.0, 6.0), (3.0, 1.0)],
+          [(2.0, 3.0), (3.0, 3.0), (2.0, 4.0), (2.0, 3.0)]], (1.0, 1.0, 6.0, 7.0)],
+        [np.array([[(1.0, 4.0), (3.0,1.0), (6.0, 2.0), (6.0, 6.0), (2.0, 7.0)]]), (1.0, 1.0, 6.0, 7.0)],
+        [[np.array([(3.0, 1.0), (1.0, 4.0), (2.0, 7.0), (6.0, 6.0), (3.0, 1.0)]),
+          np.array([(2.0, 3.0), (3.0, 3.0), (2.0, 4.0), (2.0, 3.0)])], (1.0, 1.0, 6.0, 7.0)],
+        [[[(1.0, 4.0, 9.0), (3.0,1.0, 0.0), (6.0, 2.0, 1.0), (2.0, 7.0, 5.0)]], (1.0, 1.0, 6.0, 7.0)]
     ])
     def test_bbox(self, polygon, bbox):
         assert utils.bbox(polygon) == bbox
@@ -54,15 +90,48 @@ class TestGrid:
     def test_create_rectangle_grid_morton(self):
         bbox = (1032.05, 286175.81, 304847.26, 624077.50)
         grid = utils.create_rectangle_grid_morton(bbox=bbox, hspacing=10000,
-                                                  vspacing=10000)
-        lvls = math.log(len(grid), 4)
-        assert lvls.is_integer()
+                                                  vspacing=10000, as_dict=True)
+        n = len(grid)
+        depth_bits = (n - 1).bit_length()
+        assert n == 1 << depth_bits and depth_bits % 2 == 0
+
+    @pytest.mark.parametrize('nr_cells', [2, 8, 15, 17, 32, 4**6 + 1])
+    def test_index_quadtree_not_full(self, nr_cells):
+        with pytest.raises(ValueError):
+            utils.index_quadtree(np.arange(nr_cells, dtype=np.uint64))
+
+    def test_create_rectangle_grid_morton_sorted(self):
+        bbox = (1032.05, 286175.81, 304847.26, 624077.50)
+        codes, grid = utils.create_rectangle_grid_morton(bbox=bbox,
+                                                         hspacing=10000,
+                                                         vspacing=10000)
+        assert codes.dtype == np.uint64
+        assert len(codes) == len(grid)
+        assert np.all(codes[:-1] < codes[1:])
+        expect = utils.create_rectangle_grid_morton(bbox=bbox, hspacing=10000,
+                                                    vspacing=10000,
+                                                    as_dict=True)
+        assert codes.tolist() == list(expect)
+
+    def test_create_rectangle_grid_morton_cached(self):
+        bbox = [1032.05, 286175.81, 304847.26, 624077.50]
+        codes, grid = utils.create_rectangle_grid_morton(bbox=bbox,
+                                                         hspacing=10000,
+                                                         vspacing=10000)
+        codes_2, grid_2 = utils.create_rectangle_grid_morton(bbox=tuple(bbox),
+                                                             hspacing=10000,
+                                                             vspacing=10000)
+        assert codes is codes_2 and grid is grid_2
+        with pytest.raises(ValueError):
+            grid[0, 0, 0, 0] = 0.0
 
     def test_index_quadtree(self):
         bbox = (1032.05, 286175.81, 304847.26, 624077.50)
-        grid = utils.create_rectangle_grid_morton(bbox=bbox, hspacing=10000,
-                                                  vspacing=10000)
-        utils.index_quadtree(grid)
+        codes, grid = utils.create_rectangle_grid_morton(bbox=bbox,
+                                                         hspacing=10000,
+                                                         vspacing=10000)
+        quadtree = utils.index_quadtree(codes)
+        assert list(quadtree.values()) == codes.tolist()
         log.debug("bla")
 
 class TestSorting:
@@ -76,12 +145,42 @@ class TestSorting:
     def test_morton_code(self, point):
         utils.morton_code(*point)
 
+    def test_morton_encode_2d_vec(self):
+        points = [(0, 0), (1.0, 1.0), (96663.25590546813, 439718.94288361823),
+                  (252914.232, 608211.603), (-12.5, 3.75)]
+        x, y = zip(*points)
+        morton_keys = utils.morton_encode_2d_vec(np.array(x), np.array(y))
+        assert morton_keys.dtype == np.uint64
+        assert morton_keys.tolist() == [utils.morton_code(*p) for p in points]
+
+    @pytest.mark.parametrize('morton_key', [0, 1, 2, 0x5555555555555555,
+                                            0xaaaaaaaaaaaaaaaa,
+                                            0xffffffffffffffff,
+                                            0x123456789abcdef0])
+    def test_rev_morton_code_deinterleave(self, morton_key):
+        x, y = utils.deinterleave(morton_key)
+        assert utils.rev_morton_code(morton_key) == (x / 100.0, y / 100.0)
+
     def test_rev_morton_code(self):
         point = (252914.232, 608211.603)
         morton_key = utils.morton_code(*point)
         point_res = utils.rev_morton_code(morton_key)
-        assert pytest.approx(point[0], point_res[0]) and \
-               pytest.approx(point[1], point_res[1])
+        assert point_res[0] == pytest.approx(point[0], abs=1e-2)
+        assert point_res[1] == pytest.approx(point[1], abs=1e-2)
+
+    def test_morton_decode_2d_vec(self):
+        morton_keys = [0, 1, 2, 0x5555555555555555, 0xffffffffffffffff,
+                       utils.morton_code(252914.232, 608211.603)]
+        coords = utils.morton_decode_2d_vec(np.array(morton_keys,
+                                                     dtype=np.uint64))
+        assert coords.tolist() == [list(utils.rev_morton_code(k))
+                                   for k in morton_keys]
+
+    def test_roundtrip_batch(self):
+        pts = np.random.default_rng(0).uniform(0, 1e6, size=(100000, 2))
+        morton_keys = utils.morton_encode_2d_vec(pts[:, 0], pts[:, 1])
+        coords = utils.morton_decode_2d_vec(morton_keys)
+        np.testing.assert_allclose(coords, pts, rtol=0, atol=1e-2)
 
 class TestParsing:
     @pytest.mark.parametrize('lod_num, lod_str',[
@@ -104,10 +203,94 @@ class TestParsing:
         assert utils.parse_lod_value(lod_key) == lod_str
 
 
+@pytest.mark.parametrize('n, expect', [
+    (2, [['a', 'b'], ['c', 'd'], ['e']]),
+    (5, [['a', 'b', 'c', 'd', 'e']]),
+    (32, [['a', 'b', 'c', 'd', 'e']]),
+])
+def test_batched(n, expect):
+    assert list(utils.batched(('a', 'b', 'c', 'd', 'e'), n)) == expect
+
+
+class TestVertices:
+    def test_clean_vertices(self):
+        j = {
+            "CityObjects": {
+                "a": {"geometry": [{"boundaries": [[[0, 1, 2]], [[3, 1, 4]]]}]},
+                "b": {"geometry": [{"boundaries": [[0, 4, 2]]}]}
+            },
+            "vertices": [[1.0, 1.0, 0.0], [0.0, 0.0, 0.0], [1.0, 0.0, 0.0],
+                         [1.0001, 1.0, 0.0], [0.0, 1.0, 0.0], [9.0, 9.0, 9.0]]
+        }
+        removed = utils.clean_vertices(j, precision=3)
+        assert removed == (1, 1)
+        assert j["vertices"] == [[1.0, 1.0, 0.0], [0.0, 0.0, 0.0],
+                                 [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+        assert j["CityObjects"]["a"]["geometry"][0]["boundaries"] == \
+               [[[0, 1, 2]], [[0, 1, 3]]]
+        assert j["CityObjects"]["b"]["geometry"][0]["boundaries"] == \
+               [[0, 3, 2]]
+        assert j["metadata"]["geographicalExtent"] == [0.0, 0.0, 0.0,
+                                                       1.0, 1.0, 0.0]
+
+    def test_clean_vertices_precision(self):
+        j = {
+            "CityObjects": {"a": {"geometry": [{"boundaries": [[[0, 1, 2]]]}]}},
+            "vertices": [[85000.12345, 445000.98765, 1.23456],
+                         [85001.0, 445000.5, 2.0],
+                         [85000.12341, 445000.98771, 1.23459]]
+        }
+        removed = utils.clean_vertices(j, precision=3)
+        assert removed == (1, 0)
+        assert j["vertices"] == [[85000.12345, 445000.98765, 1.23456],
+                                 [85001.0, 445000.5, 2.0]]
+        assert j["CityObjects"]["a"]["geometry"][0]["boundaries"] == \
+               [[[0, 1, 0]]]
+
+    def test_clean_vertices_transform(self):
+        j = {
+            "CityObjects": {"a": {"geometry": [{"boundaries": [[[2, 1, 0]]]}]}},
+            "vertices": [[0, 0, 0], [1000, 0, 500], [1000, 0, 500]],
+            "transform": {"scale": [0.001, 0.001, 0.001],
+                          "translate": [10.0, 20.0, 0.0]}
+        }
+        removed = utils.clean_vertices(j)
+        assert removed == (1, 0)
+        assert j["vertices"] == [[1000, 0, 500], [0, 0, 0]]
+        assert j["CityObjects"]["a"]["geometry"][0]["boundaries"] == \
+               [[[0, 0, 1]]]
+        assert j["metadata"]["geographicalExtent"] == \
+               pytest.approx([10.0, 20.0, 0.0, 11.0, 20.0, 0.5])
+
+    def test_compress(self):
+        j = {
+            "CityObjects": {"a": {"geometry": [{"boundaries": [[[0, 1, 2]]]}]}},
+            "vertices": [[85000.1234, 445000.0, 1.0], [85001.0, 445000.5, 2.0],
+                         [85000.1231, 445000.0004, 1.0]]
+        }
+        assert utils.compress(j, important_digits=3)
+        assert j["transform"] == {"scale": [0.001, 0.001, 0.001],
+                                  "translate": [85000.1231, 445000.0, 1.0]}
+        assert j["vertices"] == [[0, 0, 0], [877, 500, 1000]]
+        assert j["CityObjects"]["a"]["geometry"][0]["boundaries"] == \
+               [[[0, 1, 0]]]
+        assert not utils.compress(j)
+
+
 def test_zip_json(data_dir):
     """Write a zipped json with various compression"""
     with (data_dir / "ic3.json").open("r") as fin:
         data = fin.read()
     utils.write_zip(data=data.encode("utf-8"),
                     filename="ic3.json",
-                    outdir=Path("/tmp"))
\ No newline at end of file
+                    outdir=Path("/tmp"))
+
+def test_dumps_json(monkeypatch):
+    """Serialize to the same compact JSON with or without orjson"""
+    obj = {"a": [1, 2.5, None], "b": "ő", "c": {"d": [[0.1, -3]]}}
+    default = utils.dumps_json(obj)
+    monkeypatch.setattr(utils, "orjson", None)
+    without_orjson = utils.dumps_json(obj)
+    assert isinstance(default, bytes) and isinstance(without_orjson, bytes)
+    assert b" " not in without_orjson
+    assert json.loads(default) == json.loads(without_orjson) == obj